@@ -1,31 +1,51 @@
+import contextlib
 import os
-import uuid
+import secrets
+import threading
+import time
 from datetime import datetime, timedelta
 from typing import List, Optional
 
+import aiofiles
+import bcrypt
+from cachetools import TTLCache
 from fastapi import (
     Depends,
     FastAPI,
     File,
+    Header,
     HTTPException,
     UploadFile,
     status,
     Form,
 )
-from fastapi.responses import FileResponse
+from fastapi.responses import ORJSONResponse, Response
 from fastapi.staticfiles import StaticFiles
-from passlib.context import CryptContext
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
+from sqlalchemy import Index, delete, event, func, literal, or_, text
+from sqlalchemy.exc import IntegrityError
 from sqlmodel import Field, Session, SQLModel, create_engine, select
-from jose import JWTError, jwt
+import jwt
+from jwt import InvalidTokenError as JWTError
 
 SECRET_KEY = os.environ.get("JWT_SECRET", "CHANGE_THIS_SECRET_KEY")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "10"))
+TOKEN_CACHE_TTL_SECONDS = 30
+USER_CACHE_TTL_SECONDS = 60
 
 BASE_DIR = os.path.dirname(__file__)
 UPLOAD_DIR = os.path.join(BASE_DIR, "uploads")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
+UPLOAD_URL_PREFIX = "/uploads/"
+# upload names are random and never rewritten, so a URL's content never changes
+UPLOAD_CACHE_CONTROL = "public, max-age=31536000, immutable"
+ALLOWED_IMAGE_EXTS = frozenset({".png", ".jpg", ".jpeg", ".gif", ".webp"})
+UPLOAD_CHUNK_SIZE = 1 << 20
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(10 << 20)))
+# room for the content field and multipart framing on top of the image itself
+MAX_POST_BODY_BYTES = MAX_UPLOAD_BYTES + (1 << 20)
 
 class User(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
@@ -35,19 +55,27 @@ class User(SQLModel, table=True):
 
 
 class Follow(SQLModel, table=True):
+    __table_args__ = (Index("ix_follow_pair", "follower_id", "followee_id", unique=True),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
-    follower_id: int = Field(index=True)
+    follower_id: int
     followee_id: int = Field(index=True)
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
 
 class Post(SQLModel, table=True):
+    __table_args__ = (Index("ix_post_author_time", "author_id", "created_at"),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
-    author_id: int = Field(index=True)
+    author_id: int
     content: str
     image_path: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
+    @property
+    def image_url(self) -> Optional[str]:
+        return UPLOAD_URL_PREFIX + self.image_path if self.image_path else None
+
 
 class Comment(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
@@ -68,35 +96,77 @@ class Token(BaseModel):
 
 
 class PostOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
     id: int
     author_id: int
+    author_username: str
     content: str
     image_url: Optional[str]
     created_at: datetime
 
 
 class CommentOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
     id: int
     post_id: int
     author_id: int
     content: str
     created_at: datetime
 
+
 sqlite_file_name = "db.sqlite"
-engine = create_engine(f"sqlite:///{sqlite_file_name}", echo=False)
+engine = create_engine(
+    f"sqlite:///{sqlite_file_name}",
+    echo=False,
+    connect_args={"check_same_thread": False, "timeout": 30},
+    pool_size=20,
+    max_overflow=40,
+)
+
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.close()
+
 
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+    # older databases may hold duplicate follows, which would stop the unique
+    # ix_follow_pair below from building; keep the earliest row of each pair
+    first_follows = select(func.min(Follow.id)).group_by(Follow.follower_id, Follow.followee_id)
+    with engine.begin() as conn:
+        conn.execute(delete(Follow).where(Follow.id.not_in(first_follows)))
+    # create_all skips tables that already exist, so indexes added later
+    # (ix_follow_pair, ix_post_author_time) would never reach an older db.sqlite
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+    # single-column indexes now covered by the leading column of those composites
+    with engine.begin() as conn:
+        conn.execute(text("DROP INDEX IF EXISTS ix_post_author_id"))
+        conn.execute(text("DROP INDEX IF EXISTS ix_follow_follower_id"))
+
+# bcrypt only looks at the first 72 bytes; truncate like passlib did instead of
+# letting newer bcrypt releases raise on long passwords
+BCRYPT_MAX_PASSWORD_BYTES = 72
 
 
 def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+    secret = password.encode()[:BCRYPT_MAX_PASSWORD_BYTES]
+    return bcrypt.hashpw(secret, bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode()
 
 
 def verify_password(plain: str, hashed: str) -> bool:
-    return pwd_context.verify(plain, hashed)
+    secret = plain.encode()[:BCRYPT_MAX_PASSWORD_BYTES]
+    return bcrypt.checkpw(secret, hashed.encode())
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -107,54 +177,119 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return token
 
 
-def save_upload_file(upload_file: UploadFile) -> str:
-    ext = os.path.splitext(upload_file.filename)[1]
-    filename = f"{uuid.uuid4().hex}{ext}"
+async def save_upload_file(upload_file: UploadFile, ext: str) -> str:
+    if upload_file.size is not None and upload_file.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="File too large")
+    filename = secrets.token_hex(16) + ext
     path = os.path.join(UPLOAD_DIR, filename)
-    with open(path, "wb") as f:
-        f.write(upload_file.file.read())
+    written = 0
+    try:
+        async with aiofiles.open(path, "wb") as f:
+            while chunk := await upload_file.read(UPLOAD_CHUNK_SIZE):
+                written += len(chunk)
+                if written > MAX_UPLOAD_BYTES:
+                    raise HTTPException(status_code=413, detail="File too large")
+                await f.write(chunk)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        raise
     return filename
 
-app = FastAPI(title="And")
+app = FastAPI(title="And", default_response_class=ORJSONResponse)
+
+
+# FastAPI parses and spools the multipart form before any route dependency
+# runs, so the declared Content-Length has to be checked in middleware.
+# Chunked bodies carry no length and still rely on save_upload_file's cap.
+# Plain ASGI rather than @app.middleware("http") so other routes pass straight through.
+class RejectOversizedPostUpload:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "POST" and scope["path"] == "/posts":
+            for name, value in scope["headers"]:
+                if name == b"content-length":
+                    if value.isdigit() and int(value) > MAX_POST_BODY_BYTES:
+                        response = ORJSONResponse(status_code=413, content={"detail": "File too large"})
+                        await response(scope, receive, send)
+                        return
+                    break
+        await self.app(scope, receive, send)
 
-app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
+
+app.add_middleware(RejectOversizedPostUpload)
+
+
+# StaticFiles keeps HEAD and If-None-Match/304 handling; this only adds the
+# long-lived cache header. Offloading the transfer itself (nginx
+# X-Accel-Redirect) is a deployment concern and not handled here.
+class UploadStaticFiles(StaticFiles):
+    def file_response(self, *args, **kwargs) -> Response:
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = UPLOAD_CACHE_CONTROL
+        return response
+
+
+app.mount("/uploads", UploadStaticFiles(directory=UPLOAD_DIR), name="uploads")
 
 def get_session():
-    with Session(engine) as session:
+    # ids are assigned on flush and created_at in Python, so objects stay usable
+    # after commit without a refresh SELECT
+    with Session(engine, expire_on_commit=False) as session:
         yield session
 
 
-async def get_current_user(token: str = Depends(lambda: None), session: Session = Depends(get_session)):
-    from fastapi import Header
+def select_posts_with_author():
+    return select(
+        Post.id,
+        Post.author_id,
+        User.username.label("author_username"),
+        Post.content,
+        # NULL image_path concatenates to NULL, so posts without an image get image_url None
+        (literal(UPLOAD_URL_PREFIX) + Post.image_path).label("image_url"),
+        Post.created_at,
+    ).select_from(Post).join(User, User.id == Post.author_id)
+
 
-    def _inner(authorization: Optional[str] = Header(None)):
-        if authorization is None:
-            raise HTTPException(status_code=401, detail="Missing authorization header")
-        parts = authorization.split()
-        if parts[0].lower() != "bearer" or len(parts) != 2:
-            raise HTTPException(status_code=401, detail="Invalid auth header")
-        return parts[1]
+# raw token -> (exp, user_id); skips jwt.decode on repeat requests
+_token_cache = TTLCache(maxsize=10_000, ttl=TOKEN_CACHE_TTL_SECONDS)
+# user_id -> detached User; skips the user SELECT for recently seen users
+_user_cache = TTLCache(maxsize=50_000, ttl=USER_CACHE_TTL_SECONDS)
+_auth_cache_lock = threading.Lock()
 
-    token_str = _inner  
-    raise HTTPException(status_code=500, detail="Internal use only")
 
-def current_user_from_token(authorization: Optional[str] = None, session: Session = Depends(get_session)):
+def current_user_from_token(authorization: Optional[str] = Header(None), session: Session = Depends(get_session)):
     if authorization is None:
         raise HTTPException(status_code=401, detail="Missing authorization header")
-    parts = authorization.split()
-    if parts[0].lower() != "bearer" or len(parts) != 2:
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
         raise HTTPException(status_code=401, detail="Invalid authorization header")
-    token = parts[1]
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: int = payload.get("sub")
-        if user_id is None:
+    with _auth_cache_lock:
+        cached = _token_cache.get(token)
+    if cached and cached[0] > time.time():
+        user_id = cached[1]
+    else:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM], options={"require": ["exp", "sub"]})
+            user_id: int = int(payload["sub"])
+        except (KeyError, TypeError, ValueError):
             raise HTTPException(status_code=401, detail="Invalid token payload")
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Token invalid or expired")
-    user = session.get(User, user_id)
-    if not user:
-        raise HTTPException(status_code=401, detail="User not found")
+        except JWTError:
+            raise HTTPException(status_code=401, detail="Token invalid or expired")
+        with _auth_cache_lock:
+            _token_cache[token] = (payload["exp"], user_id)
+    with _auth_cache_lock:
+        user = _user_cache.get(user_id)
+    if user is None:
+        user = session.get(User, user_id)
+        if not user:
+            raise HTTPException(status_code=401, detail="User not found")
+        # detach so later commits in this or other sessions don't expire the cached instance
+        session.expunge(user)
+        with _auth_cache_lock:
+            _user_cache[user_id] = user
     return user
 
 @app.post("/register", response_model=Token)
@@ -166,8 +301,7 @@ def register(data: UserCreate, session: Session = Depends(get_session)):
     u = User(username=data.username, hashed_password=hash_password(data.password))
     session.add(u)
     session.commit()
-    session.refresh(u)
-    token = create_access_token({"sub": u.id})
+    token = create_access_token({"sub": str(u.id)})
     return {"access_token": token, "token_type": "bearer"}
 
 
@@ -177,7 +311,7 @@ def login(data: UserCreate, session: Session = Depends(get_session)):
     user = session.exec(q).first()
     if not user or not verify_password(data.password, user.hashed_password):
         raise HTTPException(status_code=401, detail="Invalid username or password")
-    token = create_access_token({"sub": user.id})
+    token = create_access_token({"sub": str(user.id)})
     return {"access_token": token, "token_type": "bearer"}
 
 @app.get("/me")
@@ -202,7 +336,12 @@ def follow(user_id: int, current_user: User = Depends(current_user_from_token),
         raise HTTPException(status_code=400, detail="Already following")
     f = Follow(follower_id=current_user.id, followee_id=user_id)
     session.add(f)
-    session.commit()
+    try:
+        session.commit()
+    except IntegrityError:
+        # a concurrent request inserted the same pair after our check
+        session.rollback()
+        raise HTTPException(status_code=400, detail="Already following")
     return {"detail": "followed"}
 
 
@@ -232,48 +371,42 @@ async def create_post(
 ):
     filename = None
     if image:
-        if not image.filename.lower().endswith((".png", ".jpg", ".jpeg", ".gif", ".webp")):
+        ext = os.path.splitext(image.filename)[1].lower()
+        if ext not in ALLOWED_IMAGE_EXTS:
             raise HTTPException(status_code=400, detail="File not supported")
-        filename = save_upload_file(image)
+        filename = await save_upload_file(image, ext)
     p = Post(author_id=current_user.id, content=content, image_path=filename)
     session.add(p)
     session.commit()
-    session.refresh(p)
-    image_url = f"/uploads/{p.image_path}" if p.image_path else None
     return PostOut(
         id=p.id,
         author_id=p.author_id,
+        author_username=current_user.username,
         content=p.content,
-        image_url=image_url,
+        image_url=p.image_url,
         created_at=p.created_at,
     )
 
 
 @app.get("/posts/{post_id}", response_model=PostOut)
 def get_post(post_id: int, session: Session = Depends(get_session)):
-    p = session.get(Post, post_id)
-    if not p:
+    q = select_posts_with_author().where(Post.id == post_id)
+    row = session.exec(q).first()
+    if not row:
         raise HTTPException(status_code=404, detail="Post not found")
-    image_url = f"/uploads/{p.image_path}" if p.image_path else None
-    return PostOut(id=p.id, author_id=p.author_id, content=p.content, image_url=image_url, created_at=p.created_at)
+    return row
 
 
-@app.get("/posts")
+@app.get("/posts", response_model=List[PostOut])
 def list_posts(limit: int = 20, offset: int = 0, session: Session = Depends(get_session)):
-    q = select(Post).order_by(Post.created_at.desc()).offset(offset).limit(limit)
+    q = (
+        select_posts_with_author()
+        .order_by(Post.created_at.desc())
+        .offset(offset)
+        .limit(limit)
+    )
     rows = session.exec(q).all()
-    result = []
-    for p in rows:
-        result.append(
-            {
-                "id": p.id,
-                "author_id": p.author_id,
-                "content": p.content,
-                "image_url": f"/uploads/{p.image_path}" if p.image_path else None,
-                "created_at": p.created_at,
-            }
-        )
-    return result
+    return rows
 
 @app.post("/posts/{post_id}/comments", response_model=CommentOut)
 def comment_post(post_id: int, content: str = Form(...), current_user: User = Depends(current_user_from_token), session: Session = Depends(get_session)):
@@ -283,7 +416,6 @@ def comment_post(post_id: int, content: str = Form(...), current_user: User = De
     c = Comment(post_id=post_id, author_id=current_user.id, content=content)
     session.add(c)
     session.commit()
-    session.refresh(c)
     return CommentOut(id=c.id, post_id=c.post_id, author_id=c.author_id, content=c.content, created_at=c.created_at)
 
 
@@ -291,29 +423,27 @@ def comment_post(post_id: int, content: str = Form(...), current_user: User = De
 def get_comments(post_id: int, session: Session = Depends(get_session)):
     q = select(Comment).where(Comment.post_id == post_id).order_by(Comment.created_at.asc())
     rows = session.exec(q).all()
-    return [CommentOut(id=r.id, post_id=r.post_id, author_id=r.author_id, content=r.content, created_at=r.created_at) for r in rows]
+    return rows
 
-@app.get("/feed")
+@app.get("/feed", response_model=List[PostOut])
 def feed(limit: int = 30, offset: int = 0, current_user: User = Depends(current_user_from_token), session: Session = Depends(get_session)):
-    q = select(Follow.followee_id).where(Follow.follower_id == current_user.id)
-    followee_ids = [r for (r,) in session.exec(q).all()]
-    ids = followee_ids + [current_user.id]
-    if not ids:
-        return []
-    q2 = select(Post).where(Post.author_id.in_(ids)).order_by(Post.created_at.desc()).offset(offset).limit(limit)
-    rows = session.exec(q2).all()
-    result = []
-    for p in rows:
-        result.append(
-            {
-                "id": p.id,
-                "author_id": p.author_id,
-                "content": p.content,
-                "image_url": f"/uploads/{p.image_path}" if p.image_path else None,
-                "created_at": p.created_at,
-            }
-        )
-    return result
+    followee_ids = select(Follow.followee_id).where(Follow.follower_id == current_user.id).scalar_subquery()
+    q = (
+        select_posts_with_author()
+        .where(or_(Post.author_id.in_(followee_ids), Post.author_id == current_user.id))
+        .order_by(Post.created_at.desc())
+        .offset(offset)
+        .limit(limit)
+    )
+    rows = session.exec(q).all()
+    return rows
 @app.on_event("startup")
 def on_startup():
     create_db_and_tables()
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # uvicorn's default loop="auto" runs on uvloop whenever it is installed
+    uvicorn.run(app, host=os.environ.get("HOST", "127.0.0.1"), port=8000)